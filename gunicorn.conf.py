@@ -0,0 +1,10 @@
+# Production server settings, used with:
+#     gunicorn health_db_for_giu:app
+# Each worker runs its own event loop and creates its own MongoDB client
+# when the app starts serving.
+bind = "0.0.0.0:8000"
+worker_class = "uvicorn_worker.UvicornWorker"
+workers = 4
+# Keep client connections open between requests so callers can reuse
+# their TCP and TLS session instead of reconnecting for every request
+keepalive = 30
@@ -1,13 +1,96 @@
-from flask import Flask, request, jsonify
+from quart import Blueprint, Quart, Response, request
 from patient_class import Patient
 import logging
-from pymongo import MongoClient
+import os
+from urllib.parse import quote_plus
+from motor.motor_asyncio import AsyncIOMotorClient
+from bson.errors import InvalidDocument
+from pymongo.errors import DuplicateKeyError, WriteError
+import writer
+from cachetools import TTLCache
+from pydantic import (BaseModel, Field, StrictInt, StrictStr,
+                      ValidationError, field_validator)
+from typing import Annotated
+import orjson
+
+app = Quart(__name__)
+bp = Blueprint("db", __name__)
+
+# Recently read test result lists, keyed by mrn.  Entries are dropped
+# after a write to that patient handled by this process.  Every server
+# worker has its own cache, so a write handled by another worker is not
+# seen here until the entry expires, up to 5 seconds later.  All access
+# happens on the event loop thread, so no lock is needed.
+_tests_cache = TTLCache(maxsize=1024, ttl=5)
+# Longer test result lists are streamed but not cached
+_CACHED_TESTS_LIMIT = 1000
+# Incremented by every write.  A database read only stores its result
+# in the cache if no write happened while it was in progress, since it
+# may otherwise hold data from before the write.
+_cache_generation = 0
+
+_VALID_BLOOD_TYPES = frozenset({"A+", "A-", "B+", "B-",
+                                "AB+", "AB-", "O+", "O-"})
+
+# Enforced by MongoDB on every write to the Patients collection
+_PATIENT_SCHEMA = {
+    "bsonType": "object",
+    "required": ["mrn", "blood_type"],
+    "properties": {
+        "mrn": {"bsonType": ["int", "long"]},
+        "blood_type": {"enum": sorted(_VALID_BLOOD_TYPES)},
+    },
+}
+
+# MongoDB stores integers as at most 64-bit signed values
+Int64 = Annotated[StrictInt, Field(ge=-2**63, lt=2**63)]
+# The /get_results/<int:patient_id> route only matches non-negative ids,
+# so patients can only be created with an id that can be read back
+MRN = Annotated[StrictInt, Field(ge=0, lt=2**63)]
+
+
+class NewPatientIn(BaseModel):
+    """Expected input of the "/new_patient" route"""
+    name: StrictStr
+    id: MRN
+    blood_type: StrictStr
+
+    @field_validator("name")
+    @classmethod
+    def check_full_name(cls, name):
+        first_name, sep, last_name = name.partition(" ")
+        if not (first_name and sep and last_name):
+            raise ValueError("name must be a first and a last name "
+                             "separated by a space")
+        return name
+
+
+class AddTestIn(BaseModel):
+    """Expected input of the "/add_test" route"""
+    id: MRN
+    test_name: StrictStr
+    test_result: Int64
+
+
+def ojsonify(data):
+    """Creates a JSON response using orjson
+
+    Works like jsonify, but encodes the data with orjson, which is
+    considerably faster than the standard library json module for
+    long lists such as patient test results.
 
-app = Flask(__name__)
+    Args:
+        data: the JSON-serializable data to send
+
+    Returns:
+        Response: a response with an application/json body
+    """
+    return Response(orjson.dumps(data), mimetype="application/json")
 
 
-@app.route("/new_patient", methods=["POST"])
-def post_new_patient():
+@bp.route("/new_patient", methods=["POST"],
+          provide_automatic_options=False, strict_slashes=False)
+async def post_new_patient():
     """Adds a new patient to the database
 
     The "/new_patient" route is called to add a new patient to
@@ -33,89 +116,62 @@ def post_new_patient():
         int: Response code of 200 or 400
     """
     # Get the input data
-    in_data = request.get_json()
+    in_data = await request.get_json()
     # Validate the input
-    expected_keys = ["name", "id", "blood_type"]
-    expected_types = [str, int, str]
-    check_results = validate_post_input(
-        in_data, expected_keys, expected_types)
-    if check_results is not True:
-        return check_results, 400
-    check_blood_type = validate_blood_type(in_data["blood_type"])
-    if check_blood_type is not True:
-        return check_blood_type, 400
+    try:
+        NewPatientIn.model_validate(in_data)
+    except ValidationError as e:
+        return e.json(), 400
     # Call helper functions to implement the route
-    add_patient_to_db(in_data)
+    result = await add_patient_to_db(in_data)
+    if result is not True:
+        return result, 400
     # Return a response
-    logging.info("Entry added: {}".format(in_data))
+    logging.info("Entry added: %s", in_data)
     answer = {"message": "Patient added",
               "data": in_data}
-    return jsonify(answer), 200
-
-
-def validate_post_input(in_data, expected_keys, expected_types):
-    """Validates the dictionary that is received with POST requests
+    return ojsonify(answer), 200
 
-    The POST requests for this server receive JSON-encoded
-    dictionaries with the needed input for the route.  This
-    function checks that the needed keys can be found in the
-    dictionary and that the values for each key are of the
-    expected type.  The function will return True if all
-    validation is successful.  It will return a string with an
-    error message if something fails validation.
-
-    Args:
-        in_data (dict): The input dictionary received by the route
-        expected_keys (list[str]): a list of strings with the
-            key names that should be found in the input dictionary.
-        expected_types (list[Type]): a list of data types, in the
-            same order as the keys, that indicate the expected
-            data type for value of the dictionary.
 
-    Returns:
-        bool: A value of True if all validation passes, or
-        str: A string containins an error message if validation
-            fails.
-    """
-    for ex_key, ex_type in zip(expected_keys, expected_types):
-        if ex_key not in in_data:
-            return "Key {} is not found in input.".format(ex_key)
-        if type(in_data[ex_key]) is not ex_type:
-            return ("The value for key {}".format(ex_key) +
-                    " is not the expected type of {}.".format(ex_type))
-    return True
-
-
-def validate_blood_type(blood_type):
-    valid_blood_types = ["A+", "A-", "B+", "B-", "AB+", "AB-", "O+", "O-"]
-    if blood_type in valid_blood_types:
-        return True
-    else:
-        return "Given blood type of {} is not valid.".format(blood_type)
-
-
-def add_patient_to_db(in_data):
+async def add_patient_to_db(in_data):
     """Adds patient to the database
 
     This function receives a dictionary containing patient information.
     That information is used to instantiate a Patient class instance.
-    Then, the save method of the Patient class instance is used to save
-    the patient information to the MongoDB Database.
+    Then, the patient document is handed to the batching writer, which
+    inserts it into the MongoDB Database together with any other
+    pending writes.  The database enforces a unique mrn and validates
+    the document, including the blood type, against the collection
+    schema as part of the insert.  A patient that already exists or
+    that fails validation is not added.
 
     Args:
         in_data (dict): A dictionary containing patient information.
             See the documentation for the "/new_patient" route for
             its expected contents
+
+    Returns:
+        str: A string with a message that the patient already exists
+            or was rejected by the database, or
+        bool: A value of True if the patient was added to the database.
     """
-    first_name, last_name = in_data["name"].split(" ")
+    first_name, _, last_name = in_data["name"].partition(" ")
     new_patient = Patient(first_name, last_name,
                           in_data["id"],
                           blood_type=in_data["blood_type"])
-    new_patient.save()
+    try:
+        await writer.insert_patient(new_patient.to_document())
+    except DuplicateKeyError:
+        return "Patient id of {} already exists.".format(new_patient.mrn)
+    except (InvalidDocument, WriteError) as e:
+        return str(e)
+    _invalidate_cached(new_patient.mrn)
+    return True
 
 
-@app.route("/add_test", methods=["POST"])
-def post_add_test():
+@bp.route("/add_test", methods=["POST"],
+          provide_automatic_options=False, strict_slashes=False)
+async def post_add_test():
     """Adds test result to a specific patient.
 
     This route is used to receive testing data for a specific
@@ -143,91 +199,79 @@ def post_add_test():
             failure of the request, and a response code of either
             200 or 400.
     """
-    in_data = request.get_json()
-    expected_keys = ["id", "test_name", "test_result"]
-    expected_types = [int, str, int]
-    check_input = validate_post_input(in_data,
-                                      expected_keys,
-                                      expected_types)
-    if check_input is not True:
-        return check_input, 400
-    result = add_test_to_patient(in_data)
+    in_data = await request.get_json()
+    try:
+        AddTestIn.model_validate(in_data)
+    except ValidationError as e:
+        return e.json(), 400
+    result = await add_test_to_patient(in_data)
     if result is not True:
         return result, 400
     return "Test added", 200
 
 
-def add_test_to_patient(in_data):
+async def add_test_to_patient(in_data):
     """Add test to patient record in MongoDB Database
 
-    This function first calls the get_patient function to retrieve
-    the patient from the MongoDB database.  If no patient is
-    found with the given mrn, then a string is returned indicating
-    that the Patient was not found.  If a patient was found, an
-    instance of the Patient class is returned containing the patient
-    information.  The add_test_result method of the Patient class
-    instance is invoked to add the test information to the patient
-    record.  Then, the updated record is saved to MongoDB using the
-    save method.
+    This function uses the batching writer to append the test name
+    and test result to the tests list of the patient with the given
+    mrn using an atomic $push update.  The patient record is not read
+    or rewritten, so only the new test result is sent to MongoDB.
+    If no patient is found with the given mrn, or MongoDB rejects the
+    update, then a string is returned describing the problem.
 
     Args:
         in_data: a dictionary containing information about a test to
                  be added to the patient
 
     Returns:
-        str: A string with a message that the patient wasn't found, or
+        str: A string with a message that the patient wasn't found or
+            that the test was rejected by the database, or
         bool: A value of True if the test was successfully added to
               the patient.
     """
-    patient = get_patient(in_data["id"])
-    if patient is False:
+    try:
+        added = await writer.push_test(in_data["id"],
+                                       in_data["test_name"],
+                                       in_data["test_result"])
+    except (InvalidDocument, WriteError) as e:
+        return str(e)
+    if added is False:
         return "Patient not found"
-    patient.add_test_result(in_data["test_name"],
-                            in_data["test_result"])
-    patient.save()
+    _invalidate_cached(in_data["id"])
     return True
 
 
-def get_patient(mrn):
-    """Retrieve a Patient record from MongoDB database
+def _store_cached(mrn, value, generation):
+    if generation == _cache_generation:
+        _tests_cache[mrn] = value
 
-    Using the get_patient_from_db method of the Patient class,
-    an instance of the Patient class is obtained with information
-    about the patient with the given mrn number.  That Patient
-    instance is returned.  But, if there is no patient with the
-    given mrn number, get_patient_from_db will return None and
-    this function will return a boolean value of False.
-
-    Args:
-        mrn (int):  the medical record number of the patient to find
 
-    Returns:
-        Patient:  a Patient instance containing information for the
-                  desired patient, or
-        bool:  a boolean of False if the patient does not exist in
-               the database
-    """
-    patient = Patient.get_patient_from_db(mrn)
-    if patient is None:
-        return False
-    else:
-        return patient
+def _invalidate_cached(mrn):
+    global _cache_generation
+    _cache_generation += 1
+    _tests_cache.pop(mrn, None)
 
 
-@app.route("/get_results/<patient_id>", methods=["GET"])
-def get_get_results(patient_id):
+@bp.route("/get_results/<int:patient_id>", methods=["GET"],
+          provide_automatic_options=False, strict_slashes=False)
+async def get_get_results(patient_id):
     """Obtains test results for the given patient id
 
     This variable URL route expects a patient medical record
-    number to be added in place of <patient_id>.  This function
-    first verifies that the provided <patient_id> is an integer.
-    It then verifies that the patient exists in the database.
-    If so, the list of test results is returned.  If not, an error
-    message is return.
+    number to be added in place of <patient_id>.  The URL converter
+    only matches an integer <patient_id>, so any other value results
+    in a 404 response without calling this function.  This function
+    verifies that the patient exists in the database.  If so, the
+    list of test results is returned.  If the list was read within
+    the last few seconds and has no more than _CACHED_TESTS_LIMIT
+    results, it is sent from the in-memory cache.  Otherwise, the list
+    is streamed from the database as it is encoded, so long lists of
+    test results are not buffered in memory.  If the patient does not
+    exist, an error message is return.
 
     Args:
-        patient_id (str): A string that contains the patient_id
-            extracted from the route URL.
+        patient_id (int): The patient_id extracted from the route URL.
 
     Returns:
         list, int:   A list of the test results for the specified
@@ -235,54 +279,143 @@ def get_get_results(patient_id):
         str, int:  A string containing an error message if there
             was a problem with the request and a response status code.
     """
-    mrn = validate_patient_id(patient_id)
-    if mrn is False:
-        return "Given patient id is not an integer", 400
-    patient = get_patient(mrn)
-    if patient is False:
-        return "Patient id of {} not found in database.".format(mrn), 400
-    return jsonify(patient.tests), 200
+    tests = _tests_cache.get(patient_id)
+    if tests is not None:
+        return ojsonify(tests), 200
+    tests = await stream_patient_tests(patient_id)
+    if tests is False:
+        return ("Patient id of {} not found in database."
+                .format(patient_id), 400)
+    return Response(tests, mimetype="application/json"), 200
+
+
+async def stream_patient_tests(mrn):
+    """Prepare a streamed JSON list of the test results of a patient
+
+    The test results are read from the MongoDB database one at a time
+    using the iter_tests method of the Patient class.  The first
+    result is read right away to find out whether the patient exists.
+    The remaining results are only read, and encoded with orjson, as
+    the returned generator is consumed, so the full list is never held
+    in memory.  Once all results have been sent, a list of at most
+    _CACHED_TESTS_LIMIT results is stored in the in-memory cache,
+    unless a write happened while it was being read.
 
+    Args:
+        mrn (int):  the medical record number of the patient to find
 
-def validate_patient_id(patient_id):
-    try:
-        mrn = int(patient_id)
-    except ValueError:
+    Returns:
+        async_generator:  a generator of bytes that together form the
+                          JSON-encoded list of test results, or
+        bool:  a boolean of False if the patient does not exist in
+               the database
+    """
+    generation = _cache_generation
+    cursor = Patient.iter_tests(mrn)
+    first = await anext(cursor, None)
+    if first is None:
         return False
-    return mrn
+    return _generate_tests_json(mrn, first, cursor, generation)
+
+
+async def _generate_tests_json(mrn, first, cursor, generation):
+    tests = []
+    yield b"["
+    # A patient without tests is returned as a single document
+    # without a "test" field
+    if "test" in first:
+        tests.append(first["test"])
+        yield orjson.dumps(first["test"])
+        async for doc in cursor:
+            # Only short lists are kept for the cache, so that long
+            # ones are still streamed without being held in memory
+            if tests is not None:
+                if len(tests) < _CACHED_TESTS_LIMIT:
+                    tests.append(doc["test"])
+                else:
+                    tests = None
+            yield b","
+            yield orjson.dumps(doc["test"])
+    yield b"]"
+    if tests is not None:
+        _store_cached(mrn, tests, generation)
+
+
+@app.before_serving
+async def initialize_server():
+    """Prepares the server before it starts accepting requests
+
+    Quart runs this coroutine once in every server process after the
+    event loop has been created, so each worker gets its own
+    AsyncIOMotorClient and batching writer bound to its own loop.
+    A MongoDB client is not fork-safe, so it must never be created
+    in the parent process before the server forks its workers.
+    """
+    logging.basicConfig(filename="health_db_server.log",
+                        filemode='a',
+                        level=logging.INFO,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    await connect_to_db()
+    writer.start_writer()
+    await add_patient_to_db({"name": "Ann Ables",
+                             "id": 1,
+                             "blood_type": "A+"})
 
 
-def initialize_server():
-    logging.basicConfig(filename="health_db_server.log",
-                        filemode='w',
-                        level=logging.INFO)
-    connect_to_db()
-    add_patient_to_db({"name": "Ann Ables",
-                       "id": 1,
-                       "blood_type": "A+"})
+@app.after_serving
+async def shutdown_server():
+    await writer.stop_writer()
+    if Patient.client is not None:
+        Patient.client.close()
+        Patient.client = None
 
 
-def connect_to_db():
+async def connect_to_db():
     """Setup connection to MongoDB Database
 
     The url string contains the connection string needed to access
-    MongoDB.  Then, a MongoClient is created using this url and
-    saved in the Patient.client class attribute.  A specific database
+    MongoDB.  Then, an AsyncIOMotorClient is created using this url and
+    saved in the Patient.client class attribute.  The client's
+    connection pool is sized explicitly so that warm connections to
+    Atlas are kept ready for bursts of requests instead of paying for
+    a new TCP and TLS handshake on a cold slot.  A specific database
     and document collection are then created and stored in the
-    Patient class.
+    Patient class.  Finally, a unique index on the mrn field is
+    created, if it does not exist yet, so that patient lookups are an
+    index seek and duplicate patients are rejected by the database,
+    and the patient JSON schema is installed as the collection
+    validator so that invalid patients are rejected by the insert
+    itself.  The validator uses the "moderate" validation level, so
+    existing documents that do not match the schema can still be
+    updated, for example to add test results.  Installing the
+    validator runs collMod, which requires the database user to have
+    the collMod privilege (e.g. the dbAdmin role); if it fails, the
+    error is raised and the server does not start.
     """
-    import os
-    mongo_id = os.environment.get("MongoDB_ID")
-    mongo_pswd = os.environment.get("MongoDB_pswd")
+    # Escape characters such as "@", ":" and "/" that would otherwise
+    # break the connection string
+    mongo_id = quote_plus(os.environ["MongoDB_ID"])
+    mongo_pswd = quote_plus(os.environ["MongoDB_pswd"])
     print("Connecting to database...")
-    url = ("mongodb+srv://{}:{}@bme547.ete3u.mongodb.net/?  	  			    		retryWrites=true&w=majority&appName=BME547"
-                .format(mongo_id, mongo_pswd))
-    Patient.client = MongoClient(url)
+    url = (f"mongodb+srv://{mongo_id}:{mongo_pswd}"
+           "@bme547.ete3u.mongodb.net/"
+           "?retryWrites=true&w=majority&appName=BME547")
+    Patient.client = AsyncIOMotorClient(url,
+                                        maxPoolSize=50,
+                                        minPoolSize=10,
+                                        maxIdleTimeMS=60000,
+                                        waitQueueTimeoutMS=2500,
+                                        retryWrites=True,
+                                        socketTimeoutMS=5000,
+                                        connectTimeoutMS=3000)
     Patient.database = Patient.client["Class_Database"]
     Patient.collection = Patient.database["Patients"]
+    await Patient.collection.create_index("mrn", unique=True)
+    await Patient.database.command("collMod", "Patients",
+                                   validator={"$jsonSchema":
+                                              _PATIENT_SCHEMA},
+                                   validationLevel="moderate")
     print("Connection done")
 
 
-if __name__ == "__main__":
-    initialize_server()
-    app.run()
\ No newline at end of file
+app.register_blueprint(bp)
@@ -1,7 +1,14 @@
 class Patient:
 
+    __slots__ = ("first_name", "last_name", "mrn", "age", "tests",
+                 "blood_type")
+
+    client = None
+    database = None
+    collection = None
+
     def __init__(self, first_name, last_name,
-                 mrn, age=0, tests=None):
+                 mrn, age=0, tests=None, blood_type=None):
         self.first_name = first_name
         self.last_name = last_name
         self.mrn = mrn
@@ -10,6 +17,7 @@ class Patient:
             self.tests = []
         else:
             self.tests = tests
+        self.blood_type = blood_type
 
     def __str__(self):
         return "Patient, mrn={}, {} {}".format(self.mrn,
@@ -17,33 +25,21 @@ class Patient:
                                                self.last_name)
 
     def __eq__(self, other):
-        if isinstance(other, Patient) is False:
-            return False
-        else:
-            if (self.first_name == other.first_name
-                    and self.last_name == other.last_name
-                    and self.mrn == other.mrn
-                    and self.age == other.age):
-                return True
-            else:
-                return False
+        if not isinstance(other, Patient):
+            return NotImplemented
+        return ((self.first_name, self.last_name, self.mrn, self.age)
+                == (other.first_name, other.last_name, other.mrn,
+                    other.age))
 
     def create_output(self):
-        out_string = ""
-        out_string += "Name: {} {}\n".format(self.first_name,
-                                             self.last_name)
-        out_string += "MRN: {}\n".format(self.mrn)
-        if self.is_minor():
-            status = "Minor"
-        else:
-            status = "Adult"
-        out_string += "Status: {}\n".format(status)
-        out_string += "Test Results: {}\n".format(self.tests)
-        return out_string
+        status = "Minor" if self.is_minor() else "Adult"
+        return (f"Name: {self.first_name} {self.last_name}\n"
+                f"MRN: {self.mrn}\n"
+                f"Status: {status}\n"
+                f"Test Results: {self.tests}\n")
 
     def is_minor(self):
         if self.age == 0:
-            print("Didn't work")
             return None
         if self.age < 18:
             return True
@@ -53,3 +49,19 @@ class Patient:
     def add_test_result(self, test_name, test_value):
         new_result = (test_name, test_value)
         self.tests.append(new_result)
+
+    def to_document(self):
+        return {"mrn": self.mrn,
+                "first_name": self.first_name,
+                "last_name": self.last_name,
+                "age": self.age,
+                "blood_type": self.blood_type,
+                "tests": [list(test) for test in self.tests]}
+
+    @classmethod
+    def iter_tests(cls, mrn):
+        return cls.collection.aggregate([
+            {"$match": {"mrn": mrn}},
+            {"$unwind": {"path": "$tests",
+                         "preserveNullAndEmptyArrays": True}},
+            {"$project": {"_id": 0, "test": "$tests"}}])
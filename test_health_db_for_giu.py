@@ -0,0 +1,116 @@
+import asyncio
+import json
+import pytest
+from pydantic import ValidationError
+
+
+@pytest.mark.parametrize("test_result, expected", [
+    (2**63 - 1, True),
+    (-2**63, True),
+    (2**63, False),
+    (-2**63 - 1, False),
+    (True, False),
+])
+def test_add_test_in_bounds_test_result(test_result, expected):
+    from health_db_for_giu import AddTestIn
+    in_data = {"id": 1, "test_name": "HDL", "test_result": test_result}
+    try:
+        AddTestIn.model_validate(in_data)
+        answer = True
+    except ValidationError:
+        answer = False
+    assert answer == expected
+
+
+def test_new_patient_in_rejects_id_too_large():
+    from health_db_for_giu import NewPatientIn
+    with pytest.raises(ValidationError):
+        NewPatientIn.model_validate({"name": "Ann Ables", "id": 2**70,
+                                     "blood_type": "A+"})
+
+
+@pytest.mark.parametrize("model_name", ["NewPatientIn", "AddTestIn"])
+def test_models_reject_negative_id(model_name):
+    import health_db_for_giu
+    model = getattr(health_db_for_giu, model_name)
+    in_data = {"name": "Ann Ables", "id": -1, "blood_type": "A+",
+               "test_name": "HDL", "test_result": 100}
+    with pytest.raises(ValidationError):
+        model.model_validate(in_data)
+
+
+class FakeCursor:
+
+    def __init__(self, docs):
+        self.docs = iter(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+def stream_tests(monkeypatch, docs, mrn=1, write_during_stream=False):
+    import health_db_for_giu
+    from patient_class import Patient
+    monkeypatch.setattr(Patient, "iter_tests",
+                        lambda mrn: FakeCursor(docs))
+    monkeypatch.setattr(health_db_for_giu, "_tests_cache", {})
+
+    async def main():
+        body = await health_db_for_giu.stream_patient_tests(mrn)
+        if body is False:
+            return False
+        chunks = []
+        async for chunk in body:
+            chunks.append(chunk)
+            if write_during_stream and len(chunks) == 1:
+                health_db_for_giu._invalidate_cached(2)
+        return b"".join(chunks)
+    return asyncio.run(main())
+
+
+def unwound(tests):
+    return [{"test": test} for test in tests]
+
+
+def test_stream_patient_tests_missing_patient(monkeypatch):
+    import health_db_for_giu
+    assert stream_tests(monkeypatch, []) is False
+    assert health_db_for_giu._tests_cache == {}
+
+
+def test_stream_patient_tests_no_tests(monkeypatch):
+    import health_db_for_giu
+    assert stream_tests(monkeypatch, [{}]) == b"[]"
+    assert health_db_for_giu._tests_cache == {1: []}
+
+
+def test_stream_patient_tests_several_tests(monkeypatch):
+    import health_db_for_giu
+    tests = [["HDL", 100], ["LDL", 90], ["TSH", 2]]
+    body = stream_tests(monkeypatch, unwound(tests))
+    assert json.loads(body) == tests
+    assert health_db_for_giu._tests_cache == {1: tests}
+
+
+def test_stream_patient_tests_long_list_not_cached(monkeypatch):
+    import health_db_for_giu
+    monkeypatch.setattr(health_db_for_giu, "_CACHED_TESTS_LIMIT", 2)
+    tests = [["HDL", 100], ["LDL", 90], ["TSH", 2]]
+    body = stream_tests(monkeypatch, unwound(tests))
+    assert json.loads(body) == tests
+    assert health_db_for_giu._tests_cache == {}
+
+
+def test_stream_patient_tests_write_during_stream_not_cached(monkeypatch):
+    import health_db_for_giu
+    tests = [["HDL", 100], ["LDL", 90]]
+    body = stream_tests(monkeypatch, unwound(tests),
+                        write_during_stream=True)
+    assert json.loads(body) == tests
+    assert health_db_for_giu._tests_cache == {}
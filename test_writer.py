@@ -0,0 +1,208 @@
+import asyncio
+import pytest
+from bson.errors import InvalidDocument
+from pymongo import InsertOne
+from pymongo.errors import (BulkWriteError, ConnectionFailure,
+                            DuplicateKeyError, WriteError)
+from patient_class import Patient
+import writer
+
+
+class FakeResult:
+
+    def __init__(self, matched_count):
+        self.matched_count = matched_count
+
+
+class FakeCursor:
+
+    def __init__(self, docs):
+        self.docs = iter(docs)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self.docs)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeCollection:
+    """Stands in for a motor collection in the writer tests
+
+    bulk_write applies all inserts before all updates, as pymongo does
+    for an unordered bulk write.
+    """
+
+    def __init__(self, mrns=(), rejected_mrns=(), bulk_exception=None):
+        self.docs = {mrn: {"mrn": mrn, "tests": []} for mrn in mrns}
+        self.rejected_mrns = set(rejected_mrns)
+        self.bulk_exception = bulk_exception
+        self.batches = []
+
+    async def bulk_write(self, ops, ordered=True):
+        self.batches.append(ops)
+        if self.bulk_exception is not None:
+            raise self.bulk_exception
+        errors = []
+        n_inserted = 0
+        n_matched = 0
+        indexed = list(enumerate(ops))
+        inserts = [(i, op) for i, op in indexed if isinstance(op, InsertOne)]
+        updates = [(i, op) for i, op in indexed
+                   if not isinstance(op, InsertOne)]
+        for index, op in inserts:
+            doc = op._doc
+            if doc["mrn"] in self.docs:
+                errors.append({"index": index, "code": 11000,
+                               "errmsg": "E11000 duplicate key error"})
+            else:
+                self.docs[doc["mrn"]] = doc
+                n_inserted += 1
+        for index, op in updates:
+            mrn = op._filter["mrn"]
+            if mrn in self.rejected_mrns:
+                errors.append({"index": index, "code": 121,
+                               "errmsg": "Document failed validation"})
+            elif mrn in self.docs:
+                self.docs[mrn]["tests"].append(op._doc["$push"]["tests"])
+                n_matched += 1
+        if errors:
+            raise BulkWriteError({"writeErrors": errors,
+                                  "writeConcernErrors": [],
+                                  "nInserted": n_inserted,
+                                  "nUpserted": 0,
+                                  "nMatched": n_matched,
+                                  "nModified": n_matched,
+                                  "nRemoved": 0,
+                                  "upserted": []})
+        return FakeResult(n_matched)
+
+    def find(self, query, projection=None):
+        return FakeCursor([{"mrn": mrn} for mrn in query["mrn"]["$in"]
+                           if mrn in self.docs])
+
+
+def run_writes(collection, *writes):
+    async def main():
+        writer.start_writer()
+        try:
+            return await asyncio.gather(*writes, return_exceptions=True)
+        finally:
+            await writer.stop_writer()
+    Patient.collection = collection
+    return asyncio.run(main())
+
+
+def patient_doc(mrn):
+    return Patient("Ann", "Ables", mrn, blood_type="A+").to_document()
+
+
+def test_duplicate_inserts_in_one_batch():
+    collection = FakeCollection()
+    results = run_writes(collection,
+                         writer.insert_patient(patient_doc(1)),
+                         writer.insert_patient(patient_doc(1)),
+                         writer.insert_patient(patient_doc(2)))
+    assert len(collection.batches) == 1
+    assert results[0] is True
+    assert isinstance(results[1], DuplicateKeyError)
+    assert results[2] is True
+
+
+@pytest.mark.parametrize("missing_first", [True, False])
+def test_push_test_to_missing_and_existing_mrn(missing_first):
+    collection = FakeCollection(mrns=[1])
+    pushes = [writer.push_test(2, "HDL", 100),
+              writer.push_test(1, "LDL", 90)]
+    if not missing_first:
+        pushes.reverse()
+    results = run_writes(collection, *pushes)
+    if not missing_first:
+        results.reverse()
+    assert len(collection.batches) == 1
+    assert results == [False, True]
+    assert collection.docs[1]["tests"] == [["LDL", 90]]
+
+
+def test_bulk_write_error_only_fails_rejected_writes():
+    collection = FakeCollection(mrns=[1, 2], rejected_mrns=[2])
+    results = run_writes(collection,
+                         writer.push_test(1, "HDL", 100),
+                         writer.push_test(2, "HDL", 100),
+                         writer.insert_patient(patient_doc(3)))
+    assert len(collection.batches) == 1
+    assert results[0] is True
+    assert isinstance(results[1], WriteError)
+    assert not isinstance(results[1], DuplicateKeyError)
+    assert results[1].code == 121
+    assert results[2] is True
+
+
+def test_bulk_write_exception_fails_whole_batch():
+    error = ConnectionFailure("network down")
+    collection = FakeCollection(mrns=[1], bulk_exception=error)
+    results = run_writes(collection,
+                         writer.push_test(1, "HDL", 100),
+                         writer.insert_patient(patient_doc(2)))
+    assert results == [error, error]
+
+
+def test_stop_writer_fails_in_flight_and_queued_writes():
+    class BlockingCollection(FakeCollection):
+        async def bulk_write(self, ops, ordered=True):
+            self.batches.append(ops)
+            await asyncio.Event().wait()
+
+    async def main():
+        writer.start_writer()
+        in_flight = asyncio.ensure_future(
+            writer.insert_patient(patient_doc(1)))
+        await asyncio.sleep(0.05)
+        queued = asyncio.ensure_future(
+            writer.insert_patient(patient_doc(2)))
+        await asyncio.sleep(0)
+        await writer.stop_writer()
+        return await asyncio.gather(in_flight, queued,
+                                    return_exceptions=True)
+    collection = BlockingCollection()
+    Patient.collection = collection
+    results = asyncio.run(main())
+    assert len(collection.batches) == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_unencodable_write_is_rejected_before_queuing():
+    collection = FakeCollection(mrns=[1])
+    results = run_writes(collection,
+                         writer.push_test(1, "HDL", 2**70),
+                         writer.push_test(1, "LDL", 90),
+                         writer.insert_patient(patient_doc(2**70)))
+    assert isinstance(results[0], InvalidDocument)
+    assert results[1] is True
+    assert isinstance(results[2], InvalidDocument)
+    assert collection.docs[1]["tests"] == [["LDL", 90]]
+    assert len(collection.batches) == 1
+    assert len(collection.batches[0]) == 1
+
+
+def test_failed_lookup_only_fails_unresolved_updates():
+    error = ConnectionFailure("network down")
+
+    class FailingFindCollection(FakeCollection):
+        def find(self, query, projection=None):
+            raise error
+
+    collection = FailingFindCollection(mrns=[1])
+    results = run_writes(collection,
+                         writer.push_test(1, "HDL", 100),
+                         writer.push_test(2, "HDL", 100),
+                         writer.insert_patient(patient_doc(1)),
+                         writer.insert_patient(patient_doc(3)))
+    assert len(collection.batches) == 1
+    assert results[0] is error
+    assert results[1] is error
+    assert isinstance(results[2], DuplicateKeyError)
+    assert results[3] is True
@@ -0,0 +1,206 @@
+import asyncio
+import bson
+from bson.errors import InvalidDocument
+from pymongo import InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, WriteError
+from patient_class import Patient
+
+MAX_BATCH_SIZE = 100
+MAX_BATCH_DELAY = 0.01
+
+_queue = None
+_task = None
+
+
+def start_writer():
+    """Starts the background task that batches database writes
+
+    Must be called from within the running event loop, after
+    connect_to_db has set up Patient.collection.  Write requests from
+    the route handlers are placed on a queue and are sent to MongoDB
+    by this task in groups using a single bulk_write call.
+    """
+    global _queue, _task
+    _queue = asyncio.Queue()
+    _task = asyncio.create_task(_run(Patient.collection))
+
+
+async def stop_writer():
+    """Stops the background write task
+
+    Writes that are still waiting on the queue, or that were being
+    sent when the task was stopped, are failed with a RuntimeError so
+    that no caller is left waiting for them.
+    """
+    global _task
+    if _task is None:
+        return
+    task = _task
+    _task = None
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    while not _queue.empty():
+        _, _, future = _queue.get_nowait()
+        _resolve(future, exception=_stopped_error())
+
+
+async def insert_patient(doc):
+    """Queues a new patient document to be inserted into the database
+
+    Args:
+        doc (dict): the patient document to insert, as created by
+            Patient.to_document
+
+    Returns:
+        bool: True once the document has been inserted
+
+    Raises:
+        InvalidDocument: if the document cannot be encoded as BSON.
+            It is then not queued.
+        WriteError: if MongoDB rejected the insert.  A duplicate mrn
+            raises the DuplicateKeyError subclass.
+    """
+    _check_encodable(doc)
+    await _submit(InsertOne(doc), doc["mrn"])
+    return True
+
+
+async def push_test(mrn, test_name, test_value):
+    """Queues a test result to be appended to a patient's tests
+
+    Args:
+        mrn (int): the medical record number of the patient
+        test_name (str): the name of the test
+        test_value (int): the result of the test
+
+    Returns:
+        bool: True if the test was added, or False if no patient with
+            the given mrn exists in the database
+
+    Raises:
+        InvalidDocument: if the update cannot be encoded as BSON.  It
+            is then not queued.
+        WriteError: if MongoDB rejected the update
+    """
+    query = {"mrn": mrn}
+    push = {"$push": {"tests": [test_name, test_value]}}
+    _check_encodable(query)
+    _check_encodable(push)
+    return await _submit(UpdateOne(query, push), mrn)
+
+
+def _check_encodable(doc):
+    # pymongo only encodes the operations when bulk_write sends them,
+    # and an encoding error there fails every write in the batch, so
+    # a write that cannot be encoded is rejected before it is queued
+    try:
+        bson.encode(doc)
+    except OverflowError as e:
+        raise InvalidDocument(str(e)) from e
+
+
+async def _submit(op, mrn):
+    if _task is None:
+        raise _stopped_error()
+    future = asyncio.get_running_loop().create_future()
+    await _queue.put((op, mrn, future))
+    return await future
+
+
+async def _run(collection):
+    while True:
+        batch = [await _queue.get()]
+        try:
+            await _fill_batch(batch)
+            await _flush(collection, batch)
+        except asyncio.CancelledError:
+            for _, _, future in batch:
+                _resolve(future, exception=_stopped_error())
+            raise
+        except Exception as e:
+            for _, _, future in batch:
+                _resolve(future, exception=e)
+
+
+async def _fill_batch(batch):
+    # A lone write on an idle server is sent right away.  Only when
+    # more writes are already queued is it worth waiting up to
+    # MAX_BATCH_DELAY for others to join the batch.
+    if _queue.empty():
+        return
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + MAX_BATCH_DELAY
+    while len(batch) < MAX_BATCH_SIZE:
+        timeout = deadline - loop.time()
+        if timeout <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(_queue.get(), timeout))
+        except asyncio.TimeoutError:
+            break
+
+
+async def _flush(collection, batch):
+    errors = {}
+    try:
+        result = await collection.bulk_write(
+            [op for op, _, _ in batch], ordered=False)
+        n_matched = result.matched_count
+    except BulkWriteError as e:
+        n_matched = e.details["nMatched"]
+        for error in e.details["writeErrors"]:
+            errors[error["index"]] = error
+    # The writes have been applied, so settle everything that does not
+    # depend on the lookup below before it can fail
+    updates = []
+    for index, (op, mrn, future) in enumerate(batch):
+        if index in errors:
+            _resolve(future, exception=_write_error(errors[index]))
+        elif isinstance(op, UpdateOne):
+            updates.append((mrn, future))
+        else:
+            _resolve(future, result=True)
+    if n_matched == len(updates):
+        for _, future in updates:
+            _resolve(future, result=True)
+        return
+    # bulk_write only reports a total match count, so look up which of
+    # the updated patients actually exist
+    try:
+        found = await _existing_mrns(collection,
+                                     [mrn for mrn, _ in updates])
+    except Exception as e:
+        for _, future in updates:
+            _resolve(future, exception=e)
+        return
+    for mrn, future in updates:
+        _resolve(future, result=mrn in found)
+
+
+async def _existing_mrns(collection, mrns):
+    cursor = collection.find({"mrn": {"$in": mrns}},
+                             projection={"mrn": 1, "_id": 0})
+    return {doc["mrn"] async for doc in cursor}
+
+
+def _stopped_error():
+    return RuntimeError("The database writer has been stopped")
+
+
+def _write_error(error):
+    if error["code"] == 11000:
+        return DuplicateKeyError(error["errmsg"], error["code"], error)
+    return WriteError(error["errmsg"], error["code"], error)
+
+
+def _resolve(future, result=None, exception=None):
+    # The request that queued this write may have been cancelled
+    if future.done():
+        return
+    if exception is not None:
+        future.set_exception(exception)
+    else:
+        future.set_result(result)